@@ -3,21 +3,125 @@
 __version__ = "0.3.1"
 
 from typing import Any, Dict, Optional, Tuple, Callable
-from pathlib import PurePosixPath, Path
+from pathlib import Path
 import itertools
 import functools
+import concurrent.futures
 import json
 import math
 import importlib
-
-import numcodecs as codecs
-from numpy import array
+import inspect
 
 import zarr.storage
 from zarr.storage import array_meta_key, group_meta_key, attrs_key
 
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 _meta_keys = set([array_meta_key, group_meta_key, attrs_key])
-from zarr.util import normalize_storage_path, normalize_dimension_separator
+_shard_for_key_cache_size = 4096
+# Number of values read ahead when copying a store into a zip store
+_copy_batch_size = 256
+# Threads used to access the component stores concurrently
+_max_workers = 32
+# Stores whose operations do no I/O, so threads would only add overhead
+_in_memory_stores = (zarr.storage.MemoryStore, zarr.storage.KVStore)
+from zarr.util import (
+    json_dumps,
+    normalize_storage_path,
+    normalize_dimension_separator,
+)
+
+
+def _is_normalized(key) -> bool:
+    """Whether the key is certainly unchanged by normalize_storage_path.
+
+    Keys with a segment starting with "." are left to normalize_storage_path,
+    which rejects "." and ".." segments."""
+    return (
+        isinstance(key, str)
+        and key != ""
+        and key[0] not in "/."
+        and key[-1] != "/"
+        and "//" not in key
+        and "/." not in key
+        and "\\" not in key
+    )
+
+
+def _map_stores(func, stores, max_workers: Optional[int] = None):
+    """Apply func to each store, concurrently when there is more than one.
+
+    Listing and closing stores is dominated by filesystem or network latency.
+    At most max_workers threads are used, _max_workers by default; with 1, func
+    is applied serially in the calling thread."""
+    if max_workers is None:
+        max_workers = _max_workers
+    if len(stores) < 2 or max_workers == 1:
+        return [func(store) for store in stores]
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max_workers, len(stores))
+    ) as executor:
+        return list(executor.map(func, stores))
+
+
+def _dim_sep(store, default=None):
+    """Get the dimension separator of the store, or the default when it has none."""
+    return getattr(store, "_dimension_separator", default)
+
+
+_json_scalar_types = (str, int, float, bool, type(None))
+
+
+def _is_json_compatible(value) -> bool:
+    """Whether the value can be encoded as JSON."""
+    if isinstance(value, _json_scalar_types):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(_is_json_compatible(v) for v in value)
+    if isinstance(value, dict):
+        return all(
+            isinstance(k, _json_scalar_types) and _is_json_compatible(v)
+            for k, v in value.items()
+        )
+    return False
+
+
+@functools.lru_cache(maxsize=None)
+def _package_version(module: str) -> Optional[str]:
+    """Get the version of the package that provides the module, if available."""
+    package = importlib.import_module(module.split(".")[0])
+    return getattr(package, "__version__", None)
+
+
+@functools.lru_cache(maxsize=None)
+def _getitems_parameters(store_type: type) -> Optional[frozenset]:
+    """Names of the keyword arguments accepted by the store type's getitems,
+    or None when it accepts arbitrary keyword arguments."""
+    parameters = inspect.signature(store_type.getitems).parameters.values()
+    if any(p.kind is inspect.Parameter.VAR_KEYWORD for p in parameters):
+        return None
+    return frozenset(p.name for p in parameters)
+
+
+def _close_store(store: zarr.storage.BaseStore) -> Optional[Exception]:
+    """Close the store, returning the exception raised, if any."""
+    try:
+        store.close()
+    except Exception as e:
+        return e
+    return None
+
+
+def _array_shard_len(array_shard: zarr.storage.BaseStore) -> int:
+    """Number of keys in an array shard store, without its metadata keys.
+
+    Like in iteration, the array metadata is counted in the base store."""
+    return len(array_shard) - sum(1 for k in _meta_keys if k in array_shard)
 
 
 def array_shard_directory_store(prefix: str, **kwargs):
@@ -32,42 +136,96 @@ def array_shard_directory_store(prefix: str, **kwargs):
     return wrapper
 
 
+def _zip_store_path(prefix: str, shard_path: str, chunk_dims: Optional[str]):
+    if chunk_dims:
+        return f"{prefix}/{shard_path}/{chunk_dims}.zarr.zip"
+    elif shard_path:
+        return f"{prefix}/{shard_path}.zarr.zip"
+    return f"{prefix}.zarr.zip"
+
+
+def _zip_store(store_path: str, shard_store: zarr.storage.BaseStore):
+    """Open the zip store that the shard store is copied into."""
+    return zarr.storage.ZipStore(
+        store_path, mode="a", dimension_separator=_dim_sep(shard_store)
+    )
+
+
+def _copy_to_zip_store(
+    zip_store: zarr.storage.ZipStore,
+    shard_store: zarr.storage.BaseStore,
+    max_workers: int,
+):
+    if max_workers == 1:
+        for k in shard_store:
+            zip_store[k] = shard_store[k]
+        zip_store.flush()
+        return zip_store
+
+    # Values are read concurrently, one batch ahead of the writes, which have to
+    # be serial since ZipFile is not thread-safe.
+    keys = list(shard_store)
+    previous_batch = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start in range(0, len(keys), _copy_batch_size):
+            batch = keys[start : start + _copy_batch_size]
+            values = executor.map(shard_store.__getitem__, batch)
+            if previous_batch is not None:
+                for k, value in zip(*previous_batch):
+                    zip_store[k] = value
+            previous_batch = (batch, values)
+        if previous_batch is not None:
+            for k, value in zip(*previous_batch):
+                zip_store[k] = value
+
+    zip_store.flush()
+    return zip_store
+
+
 def to_zip_store(
     prefix: str,
     shard_store: zarr.storage.BaseStore,
     shard_path: str,
     chunk_dims: Optional[str],
+    max_workers: int = _max_workers,
 ):
-    """Convert stores to a zip store at the provided prefix."""
-    if chunk_dims:
-        store_path = f"{prefix}/{shard_path}/{chunk_dims}.zarr.zip"
-    elif shard_path:
-        store_path = f"{prefix}/{shard_path}.zarr.zip"
-    else:
-        store_path = f"{prefix}.zarr.zip"
-    Path(store_path).parent.mkdir(parents=True, exist_ok=True)
+    """Convert stores to a zip store at the provided prefix.
 
-    dimension_separator = getattr(shard_store, "_dimension_separator", None)
-    zip_store = zarr.storage.ZipStore(
-        store_path, mode="a", dimension_separator=dimension_separator
+    The values are read from up to max_workers threads."""
+    store_path = _zip_store_path(prefix, shard_path, chunk_dims)
+    Path(store_path).parent.mkdir(parents=True, exist_ok=True)
+    return _copy_to_zip_store(
+        _zip_store(store_path, shard_store), shard_store, max_workers
     )
-    for k in shard_store:
-        zip_store[k] = shard_store[k]
 
-    zip_store.flush()
-    return zip_store
 
-
-def to_zip_store_with_prefix(prefix: str):
+def to_zip_store_with_prefix(prefix: str, max_workers: int = 1):
     """Convert stores to a zip store at the provided prefix.
 
-    For use in `ShardedStore.map_shards`."""
+    For use in `ShardedStore.map_shards`. The values of each store are read from up to max_workers threads.
+    map_shards already converts up to its own max_workers stores concurrently, so by default each store is
+    read serially. With `map_shards(..., max_workers=1)`, pass the same limit here to read concurrently
+    instead."""
+
+    # Array shards share parent directories, which are only created once
+    created_directories = set()
 
     @functools.wraps(to_zip_store)
     def wrapper(
         shard_store: zarr.storage.BaseStore, shard_path: str, chunk_dims: Optional[str]
     ):
-        return to_zip_store(prefix, shard_store, shard_path, chunk_dims)
+        store_path = _zip_store_path(prefix, shard_path, chunk_dims)
+        parent = Path(store_path).parent
+        if parent not in created_directories:
+            parent.mkdir(parents=True, exist_ok=True)
+            created_directories.add(parent)
+        try:
+            zip_store = _zip_store(store_path, shard_store)
+        except FileNotFoundError:
+            # The directory was removed after it was created, e.g. between runs
+            parent.mkdir(parents=True, exist_ok=True)
+            zip_store = _zip_store(store_path, shard_store)
+        return _copy_to_zip_store(zip_store, shard_store, max_workers)
 
     return wrapper
 
@@ -75,35 +233,83 @@ def to_zip_store_with_prefix(prefix: str):
 class ShardedStore(zarr.storage.Store):
     """Store composed of a base store and additional component stores."""
 
-    def _update_internal_state(self):
-        self._mount_paths = []
-        self._array_mount_paths = []
+    # The base store classes do not define __slots__, so instances still have a
+    # __dict__, but the attributes read on every access are slot descriptors.
+    __slots__ = (
+        "base",
+        "shards",
+        "array_shards",
+        "array_shard_dims",
+        "array_shard_funcs",
+        "_dimension_separator",
+        "_enable_len_cache",
+        "_cached_len",
+        "_write_batch_size",
+        "_write_buffers",
+        "_metadata_cache",
+        "_array_metas",
+        "_shards_status",
+        "_shard_for_key_cache",
+        "_array_shard_ids",
+        "_all_stores",
+        "_component_max_workers",
+        "_array_meta_key_mounts",
+        "_min_mount_path_length",
+        "_mount_trie",
+    )
 
-        mount_paths = []
-        for shard_path in self.shards:
-            self._mount_paths.append(shard_path)
-            mount_paths.append(PurePosixPath(shard_path))
-        array_mount_paths = []
-        for shard_path in self.array_shards:
-            self._array_mount_paths.append(shard_path)
-            array_mount_paths.append(PurePosixPath(shard_path))
-
-        for mpa, mpb in itertools.permutations(mount_paths + array_mount_paths, 2):
-            if mpa in mpb.parents:
-                raise RuntimeError(f"{mpb} is a subgroup of {mpa} -- not supported")
-
-        mount_path_lengths = [
-            len(str(mp)) for mp in self._mount_paths + self._array_mount_paths
+    def _update_component_stores(self):
+        array_shard_stores = [
+            array_shard
+            for array_shards in self.array_shards.values()
+            for array_shard in array_shards.values()
         ]
-        self._mount_path_lengths = set(mount_path_lengths)
-        self._mount_paths_per_length = {}
-        for mount_path in self._mount_paths + self._array_mount_paths:
-            length = len(mount_path)
-            mount_paths = self._mount_paths_per_length.get(length, set())
-            mount_paths.add(mount_path)
-            self._mount_paths_per_length[length] = mount_paths
-        if len(mount_path_lengths):
-            self._min_mount_path_length = min(mount_path_lengths)
+        self._array_shard_ids = set(map(id, array_shard_stores))
+        self._all_stores = (self.base, *self.shards.values(), *array_shard_stores)
+        # Without I/O to overlap, the stores are accessed from the calling thread
+        self._component_max_workers = (
+            1
+            if all(isinstance(store, _in_memory_stores) for store in self._all_stores)
+            else _max_workers
+        )
+        self._shards_status = {}
+
+    def _update_internal_state(self):
+        self._shard_for_key_cache = {}
+        self._update_component_stores()
+
+        self._array_meta_key_mounts = {
+            f"{mp}/{array_meta_key}": mp for mp in self.array_shards
+        }
+
+        self._min_mount_path_length = min(
+            (len(mp) for mp in itertools.chain(self.shards, self.array_shards)),
+            default=0,
+        )
+
+        # Mount paths are indexed in a trie over their path segments. The node at
+        # which a mount path terminates holds, under the None key, the mount path,
+        # its shard store or array shard stores, and whether it is an array shard.
+        # For array shards, the record also holds the number of sharded chunk
+        # dimensions and the separator between the chunk indices in the keys.
+        # Shallower mount paths are inserted first, so a mount path nested in
+        # another one passes through the other's terminal node on insertion.
+        mounts = [(mp, shard, False, 0, None) for mp, shard in self.shards.items()]
+        separator = self._dimension_separator or "."
+        for mp, shard in self.array_shards.items():
+            mounts.append((mp, shard, True, self.array_shard_dims[mp], separator))
+        mounts.sort(key=lambda mount: mount[0].count("/"))
+        self._mount_trie = {}
+        for mount in mounts:
+            mount_path = mount[0]
+            node = self._mount_trie
+            for segment in mount_path.split("/"):
+                node = node.setdefault(segment, {})
+                if None in node:
+                    raise RuntimeError(
+                        f"{mount_path} is a subgroup of {node[None][0]} -- not supported"
+                    )
+            node[None] = mount
 
     def __init__(
         self,
@@ -111,6 +317,9 @@ class ShardedStore(zarr.storage.Store):
         shards: Optional[Dict[str, zarr.storage.BaseStore]] = None,
         array_shard_funcs: Optional[Dict[str, Tuple[int, Callable]]] = None,
         dimension_separator: Optional[str] = None,
+        enable_len_cache: bool = False,
+        write_batch_size: int = 0,
+        cache_metadata: bool = False,
     ):
         """Created the sharded store, a store composed of multiple component stores.
 
@@ -130,28 +339,49 @@ class ShardedStore(zarr.storage.Store):
             Shard for arrays when writing to a store. Mapping of array paths to the number of sharded
             dimensions and the function that will produce stores for remaining chunk dimensions. The sharded
             chunk dimensions will be passed to this function as a `/`-separated string. For example "0/0", "0/1", etc.
-            for a dimension of 2.
+            for a dimension of 2. The function may be called from multiple threads.
             Mostly commonly, this `func` is `shardedstore.array_shard_directory_store`.
 
         dimension_separator : {'.', '/'}, optional
             Separator placed between the dimensions of a chunk. The base store and and array_shard_funcs store must
             use the same dimension_separator.
+
+        enable_len_cache: bool, optional
+            Cache the number of keys in the store. The cache is invalidated by writes through the ShardedStore,
+            so only enable it when the component stores are not modified otherwise.
+
+        write_batch_size: int, optional
+            When greater than zero, writes to array shard stores are buffered per store and written once
+            write_batch_size keys are buffered for a store, when `flush` or `close` is called, or before the
+            store is read.
+
+        cache_metadata: bool, optional
+            Keep the values of metadata keys, e.g. `.zarray`, `.zgroup` and `.zattrs`, in memory once they are
+            read. The cache is invalidated by writes through the ShardedStore, so only enable it when the
+            component stores are not modified otherwise.
         """
         self.base = base
         self.shards = {}
         self.array_shards = {}
         self.array_shard_dims = {}
         self.array_shard_funcs = {}
+        self._enable_len_cache = enable_len_cache
+        self._cached_len = None
+        self._write_batch_size = write_batch_size
+        self._write_buffers = {}
+        # Keyed by the id of the store holding the key and the key in that store
+        self._metadata_cache = {} if cache_metadata else None
+        # The array metadata the array shards were last created for, per mount
+        self._array_metas = {}
 
         if dimension_separator is None:
-            dimension_separator = getattr(base, "_dimension_separator", None)
+            dimension_separator = _dim_sep(base)
         dimension_separator = normalize_dimension_separator(dimension_separator)
         self._dimension_separator = dimension_separator
-        if hasattr(base, "_dimension_separator"):
-            if base._dimension_separator != dimension_separator:
-                raise ValueError(
-                    "ShardedStore and base store must use the same dimension_separator"
-                )
+        if _dim_sep(base, dimension_separator) != dimension_separator:
+            raise ValueError(
+                "ShardedStore and base store must use the same dimension_separator"
+            )
 
         if shards:
             for p, s in shards.items():
@@ -174,8 +404,20 @@ class ShardedStore(zarr.storage.Store):
 
         store_name = store.__class__.__name__
         store_module = store.__module__
-        store_package = store_module.split(".")[0]
-        store_package = importlib.import_module(store_package)
+        # Commonly the shards of large stores, so their config is built directly
+        if type(store) is zarr.storage.DirectoryStore:
+            return {
+                "name": store_name,
+                "module": store_module,
+                "config": {
+                    "args": [store.path],
+                    "kwargs": {
+                        "normalize_keys": store.normalize_keys,
+                        "dimension_separator": store._dimension_separator,
+                    },
+                },
+                "version": zarr.__version__,
+            }
 
         config_args = []
         config_kwargs = {}
@@ -183,17 +425,14 @@ class ShardedStore(zarr.storage.Store):
             if k == "_dimension_separator":
                 config_kwargs["dimension_separator"] = store._dimension_separator
             # Avoid clobbering on re-open
-            elif k == "mode" and k in "wx":
+            elif k == "mode" and store.mode in ("w", "w-", "x"):
                 pass
             elif k in ("path", "base"):
                 config_args.append(getattr(store, k))
             elif not k.startswith("_"):
                 val = getattr(store, k)
-                try:
-                    json_serializable = json.dumps(val)
+                if _is_json_compatible(val):
                     config_kwargs[k] = val
-                except (TypeError, OverflowError):
-                    pass
         config = {
             "args": config_args,
             "kwargs": config_kwargs,
@@ -203,8 +442,9 @@ class ShardedStore(zarr.storage.Store):
             "module": store_module,
             "config": config,
         }
-        if hasattr(store_package, "__version__"):
-            storeconfig["version"] = store_package.__version__
+        store_version = _package_version(store_module)
+        if store_version is not None:
+            storeconfig["version"] = store_version
 
         return storeconfig
 
@@ -277,16 +517,18 @@ class ShardedStore(zarr.storage.Store):
         sharded_store = cls(base, shards=shards)
 
         array_shards = {}
-        array_shard_dims = {}
+        array_shard_dims = dict(config["kwargs"].get("array_shard_dims", {}))
         if "array_shards" in config["kwargs"]:
             array_shards_config = config["kwargs"]["array_shards"]
             for array_shards_path in array_shards_config:
                 array_shards[array_shards_path] = {}
                 array_shard_config = array_shards_config[array_shards_path]
                 for array_shard_path in array_shard_config:
-                    array_shard_dims[array_shards_path] = (
-                        len(array_shard_path) + 1
-                    ) // 2
+                    # Older configurations do not record the number of sharded
+                    # dimensions, so it is derived from a chunk prefix.
+                    array_shard_dims.setdefault(
+                        array_shards_path, (len(array_shard_path) + 1) // 2
+                    )
                     array_shard = cls._from_store_config(
                         array_shard_config[array_shard_path]
                     )
@@ -298,153 +540,213 @@ class ShardedStore(zarr.storage.Store):
         return sharded_store
 
     def map_shards(
-        self, func: Callable[[zarr.storage.BaseStore, str, str], zarr.storage.BaseStore]
+        self,
+        func: Callable[[zarr.storage.BaseStore, str, str], zarr.storage.BaseStore],
+        max_workers: Optional[int] = None,
     ):
         """Run the provided function on each shard in the store.
 
         The function should take the store, shard path, and optional array chunk path as inputs and return a store as an output.
 
+        The function is called from up to max_workers threads, 32 by default. Pass max_workers=1 to call it
+        serially from the calling thread. The stores produced by `to_zip_store_with_prefix` are read serially by
+        default, so the conversion uses at most max_workers threads in total.
+
         Returns a new ShardedStore with the resulting output stores."""
-        base = func(self.base, "", None)
+        self.flush()
+        # The shards are independent, and converting them is usually dominated by I/O
+        mapped = [(self.base, "", None)]
+        mapped.extend((self.shards[path], path, None) for path in self.shards)
+        for array_shards_path, array_shards in self.array_shards.items():
+            mapped.extend(
+                (array_shards[array_shard_path], array_shards_path, array_shard_path)
+                for array_shard_path in array_shards
+            )
+        mapped = iter(_map_stores(lambda args: func(*args), mapped, max_workers))
+
+        base = next(mapped)
         shards = {}
         for path in self.shards:
-            shards[path] = func(self.shards[path], path, None)
+            shards[path] = next(mapped)
         array_shard_funcs = {}
-        for p, sf in self.array_shard_funcs:
+        for p, sf in self.array_shard_funcs.items():
             array_shard_funcs[p] = (self.array_shard_dims[p], sf)
         sharded_store = self.__class__(
             base,
             shards=shards,
             array_shard_funcs=array_shard_funcs,
             dimension_separator=self._dimension_separator,
+            enable_len_cache=self._enable_len_cache,
+            write_batch_size=self._write_batch_size,
+            cache_metadata=self._metadata_cache is not None,
         )
 
         array_shards = {}
-        array_shard_dims = {}
+        array_shard_dims = dict(self.array_shard_dims)
         for array_shards_path in self.array_shards:
             array_shards[array_shards_path] = {}
             for array_shard_path in self.array_shards[array_shards_path]:
-                array_shard_dims[array_shards_path] = (len(array_shard_path) + 1) // 2
-                array_shard = func(
-                    self.array_shards[array_shards_path][array_shard_path],
-                    array_shards_path,
-                    array_shard_path,
-                )
-                array_shards[array_shards_path][array_shard_path] = array_shard
+                array_shards[array_shards_path][array_shard_path] = next(mapped)
         sharded_store.array_shards = array_shards
         sharded_store.array_shard_dims = array_shard_dims
+        sharded_store._update_internal_state()
 
         return sharded_store
 
-    def _shard_for_key(
-        self, key: str, value: bytes = None
-    ) -> Tuple[zarr.storage.BaseStore, str]:
-        norm_key = normalize_storage_path(key)
+    @staticmethod
+    def _init_array_shard(array_shard, array_meta: bytes):
+        # Equivalent to init_array with overwrite=True, but the metadata is only
+        # encoded once for all the shards.
+        zarr.storage.rmdir(array_shard)
+        array_shard[array_meta_key] = array_meta
+
+    def _create_array_shard(self, array_shard_func, chunk_prefix, array_meta: bytes):
+        array_shard = array_shard_func(chunk_prefix)
+        self._init_array_shard(array_shard, array_meta)
+        return array_shard
+
+    def _create_array_shards(self, mount_path, array_shards, value):
+        """Create the array shard stores for the array metadata written to mount_path."""
+        shard_dims = self.array_shard_dims[mount_path]
+        array_meta = _json_loads(value)
+
+        chunks = array_meta["chunks"]
+        if any([c != 1 for c in chunks[:shard_dims]]):
+            raise ValueError(
+                f"Shared chunk dimensions must be 1, received: {chunks[:shard_dims]}"
+            )
+        array_shard_func = self.array_shard_funcs[mount_path]
+        # Buffered writes precede the re-initialization of the shards
+        self.flush()
+
+        array_meta["chunks"] = chunks[shard_dims:]
+
+        chunk_shard_shape = [c for c in array_meta["shape"][:shard_dims]]
+        # The shard arrays have the unsharded dimensions, with the sharded
+        # dimensions folded into the leading one: the product over
+        # shape[: shard_dims + 1] is prod(shape[:shard_dims]) * shape[shard_dims].
+        prod = math.prod(array_meta["shape"][: shard_dims + 1])
+        array_meta["shape"] = array_meta["shape"][shard_dims:]
+        array_meta["shape"][0] = prod
+        # The remaining fields, e.g. the compressor, are already encoded
+        array_meta = json_dumps(array_meta)
+
+        prefix_separator = self._dimension_separator
+        if not prefix_separator:
+            prefix_separator = "/"
+        # Each index is converted to a string once, rather than once per prefix
+        index_strs = [[str(c) for c in range(s)] for s in chunk_shard_shape]
+        chunk_prefixes = [
+            prefix_separator.join(chunk_shard)
+            for chunk_shard in itertools.product(*index_strs)
+        ]
+        new_array_shards = []
+        if chunk_prefixes:
+            # The stores all come from the same function, so the first one is
+            # checked for all of them.
+            array_shard = array_shard_func(chunk_prefixes[0])
+            dimension_separator = self._dimension_separator
+            if _dim_sep(array_shard, dimension_separator) != dimension_separator:
+                raise ValueError(
+                    "Array shard store must use the same dimension_separator as the ShardedStore"
+                )
+            self._init_array_shard(array_shard, array_meta)
+            new_array_shards.append(array_shard)
+            # Creating the stores is dominated by filesystem or network latency,
+            # unless they are in memory
+            max_workers = (
+                1 if isinstance(array_shard, _in_memory_stores) else _max_workers
+            )
+            new_array_shards.extend(
+                _map_stores(
+                    lambda chunk_prefix: self._create_array_shard(
+                        array_shard_func, chunk_prefix, array_meta
+                    ),
+                    chunk_prefixes[1:],
+                    max_workers,
+                )
+            )
+        for chunk_prefix, array_shard in zip(chunk_prefixes, new_array_shards):
+            array_shards[chunk_prefix] = array_shard
+        self.array_shards[mount_path] = array_shards
+        self._update_component_stores()
+        self._shard_for_key_cache = {}
+
+    def _shard_for_key(self, key: str) -> Tuple[zarr.storage.BaseStore, str]:
+        shard_for_key = self._shard_for_key_cache.get(key)
+        if shard_for_key is not None:
+            return shard_for_key
+
+        shard_for_key = self._find_shard_for_key(key)
+        # Start over when full so that the keys of the chunks currently
+        # being accessed are cached, rather than the first keys seen.
+        if len(self._shard_for_key_cache) >= _shard_for_key_cache_size:
+            self._shard_for_key_cache = {}
+        self._shard_for_key_cache[key] = shard_for_key
+        return shard_for_key
+
+    def _find_shard_for_key(self, key: str) -> Tuple[zarr.storage.BaseStore, str]:
+        norm_key = key if _is_normalized(key) else normalize_storage_path(key)
 
         if len(norm_key) <= self._min_mount_path_length:
             return self.base, norm_key
 
-        norm_key_length = len(norm_key)
-        for mount_path_length in self._mount_path_lengths:
-            if norm_key_length <= mount_path_length + 1:
-                continue
-
-            norm_key_prefix = norm_key[:mount_path_length]
-            mount_paths = self._mount_paths_per_length[mount_path_length]
-            if norm_key_prefix in mount_paths:
-                if norm_key_prefix in self.array_shards:
-                    shard_dims = self.array_shard_dims[norm_key_prefix]
-                    shard_path_length = shard_dims + shard_dims
-                    if mount_path_length + shard_path_length >= norm_key_length:
-                        raise ValueError(
-                            "Array shard requested for array path with insufficient chunked dims"
-                        )
-                    postfix = str(
-                        PurePosixPath(norm_key).relative_to(
-                            PurePosixPath(norm_key_prefix)
-                        )
-                    )
-                    if postfix in _meta_keys:
-                        if postfix == array_meta_key and value is not None:
-                            array_meta_str = value.decode()
-                            array_meta = json.loads(array_meta_str)
-
-                            chunks = array_meta["chunks"]
-                            if any([c != 1 for c in chunks[:shard_dims]]):
-                                raise ValueError(
-                                    f"Shared chunk dimensions must be 1, received: {chunks[:shard_dims]}"
-                                )
-                            array_shard_func = self.array_shard_funcs[norm_key_prefix]
-                            array_shards = self.array_shards[norm_key_prefix]
-
-                            array_meta["chunks"] = chunks[shard_dims:]
-
-                            chunk_shard_shape = [
-                                c for c in array_meta["shape"][:shard_dims]
-                            ]
-                            prod = math.prod(array_meta["shape"][: shard_dims + 1])
-                            array_meta["shape"] = array_meta["shape"][shard_dims:]
-                            array_meta["shape"][0] = prod
-
-                            array_meta.pop("zarr_format", None)
-                            array_meta["compressor"] = codecs.registry.get_codec(
-                                array_meta["compressor"]
-                            )
-
-                            prefix_separator = self._dimension_separator
-                            if not prefix_separator:
-                                prefix_separator = "/"
-                            for chunk_shard in itertools.product(
-                                *(range(s) for s in chunk_shard_shape)
-                            ):
-                                chunk_prefix = prefix_separator.join(
-                                    [str(c) for c in chunk_shard]
-                                )
-                                array_shard = array_shard_func(chunk_prefix)
-                                if hasattr(array_shard, "_dimension_separator"):
-                                    if (
-                                        array_shard._dimension_separator
-                                        != self._dimension_separator
-                                    ):
-                                        raise ValueError(
-                                            "Array shard store must use the same dimension_separator as the ShardedStore"
-                                        )
-                                zarr.storage.init_array(
-                                    array_shard, overwrite=True, **array_meta
-                                )
-                                array_shards[chunk_prefix] = array_shard
-                            self.array_shards[norm_key_prefix] = array_shards
-                        return self.base, norm_key
-
-                    chunk_prefix = postfix[: shard_path_length - 1]
-                    array_shards = self.array_shards[norm_key_prefix]
-                    if chunk_prefix in array_shards:
-                        remaining_chunks = postfix[shard_path_length:]
-                        return array_shards[chunk_prefix], remaining_chunks
-
-                if norm_key_prefix in self.shards:
-                    return self.shards[norm_key_prefix], str(
-                        PurePosixPath(norm_key).relative_to(
-                            PurePosixPath(norm_key_prefix)
-                        )
-                    )
-        return self.base, norm_key
+        # Walk the trie one segment at a time so that keys in the base store,
+        # which usually miss on the first segment, are not split entirely.
+        node = self._mount_trie
+        segment_start = 0
+        while True:
+            segment_end = norm_key.find("/", segment_start)
+            if segment_end < 0:
+                return self.base, norm_key
+            node = node.get(norm_key[segment_start:segment_end])
+            if node is None:
+                return self.base, norm_key
+            if None in node:
+                (
+                    mount_path,
+                    shard,
+                    is_array_shard,
+                    shard_dims,
+                    separator,
+                ) = node[None]
+                # Both paths are normalized, so the key relative to the mount
+                # path follows its "/" separator.
+                postfix = norm_key[segment_end + 1 :]
+                break
+            segment_start = segment_end + 1
+
+        if is_array_shard:
+            if postfix in _meta_keys:
+                return self.base, norm_key
+            # Chunk indices may have multiple digits, so the chunk prefix ends
+            # at the separator that follows the last sharded chunk index.
+            # Other keys under the array path, e.g. with fewer chunk indices,
+            # are in the base store.
+            prefix_end = -1
+            for _ in range(shard_dims):
+                prefix_end = postfix.find(separator, prefix_end + 1)
+                if prefix_end < 0:
+                    return self.base, norm_key
+
+            chunk_prefix = postfix[:prefix_end]
+            array_shards = shard
+            if chunk_prefix in array_shards:
+                remaining_chunks = postfix[prefix_end + 1 :]
+                return array_shards[chunk_prefix], remaining_chunks
+            return self.base, norm_key
+
+        return shard, postfix
 
     def _get_shards_status(self, status_method):
-        base_status = [
-            getattr(self.base, status_method)(),
-        ]
-        shards_status = list(
-            map(lambda x: getattr(x, status_method)(), self.shards.values())
-        )
-        array_shards_status = []
-        for array_shards in self.array_shards.values():
-            for array_shard in array_shards:
-                status = list(
-                    map(lambda x: getattr(x, status_method)(), array_shard.values())
-                )
-                array_shards_status = array_shards_status + status
-        return all(base_status + shards_status + array_shards_status)
+        # Shard capabilities do not change, so they are only queried again
+        # when shards are added.
+        if status_method in self._shards_status:
+            return self._shards_status[status_method]
+
+        status = all(getattr(store, status_method)() for store in self._all_stores)
+        self._shards_status[status_method] = status
+        return status
 
     def is_readable(self):
         return self._get_shards_status("is_readable")
@@ -458,39 +760,308 @@ class ShardedStore(zarr.storage.Store):
     def is_erasable(self):
         return self._get_shards_status("is_erasable")
 
+    def _buffer_write(self, shard, key, value):
+        shard_id = id(shard)
+        if shard_id not in self._write_buffers:
+            self._write_buffers[shard_id] = (shard, {})
+        write_buffer = self._write_buffers[shard_id][1]
+        write_buffer[key] = value
+        if len(write_buffer) >= self._write_batch_size:
+            self._flush_write_buffer(shard)
+
+    @staticmethod
+    def _set_shard_items(shard, values):
+        if hasattr(shard, "setitems"):
+            shard.setitems(values)
+        else:
+            for k, v in values.items():
+                shard[k] = v
+
+    def _flush_write_buffer(self, shard):
+        write_buffer = self._write_buffers.pop(id(shard), None)
+        if write_buffer is not None:
+            self._set_shard_items(shard, write_buffer[1])
+
+    def flush(self):
+        """Write the buffered array shard writes to their stores."""
+        write_buffers = self._write_buffers
+        self._write_buffers = {}
+        for shard, write_buffer in write_buffers.values():
+            self._set_shard_items(shard, write_buffer)
+
     def close(self):
-        for shard in self.shards.values():
-            shard.close()
-        for array_shards in self.array_shards.values():
-            for array_shard in array_shards.values():
-                array_shard.close()
-        self.base.close()
+        self.flush()
+        # Every store is closed, even when closing another one fails
+        errors = _map_stores(
+            _close_store, self._all_stores[1:], self._component_max_workers
+        )
+        errors.append(_close_store(self.base))
+        for error in errors:
+            if error is not None:
+                raise error
+
+    # The shard lookup cache is probed inline in the item methods to avoid a
+    # method call per access when the key was seen before.
+
+    def __contains__(self, key):
+        shard, new_key = self._shard_for_key_cache.get(key) or self._shard_for_key(key)
+        if self._metadata_cache and (id(shard), new_key) in self._metadata_cache:
+            return True
+        if self._write_buffers:
+            self._flush_write_buffer(shard)
+        return new_key in shard
 
     def __delitem__(self, key):
-        shard, new_key = self._shard_for_key(key)
+        shard, new_key = self._shard_for_key_cache.get(key) or self._shard_for_key(key)
+        self._cached_len = None
+        if self._write_buffers:
+            self._flush_write_buffer(shard)
+        if self._metadata_cache:
+            self._metadata_cache.pop((id(shard), new_key), None)
         del shard[new_key]
+        if shard is self.base and new_key in self._array_meta_key_mounts:
+            self._array_metas.pop(self._array_meta_key_mounts[new_key], None)
 
     def __getitem__(self, key):
-        shard, new_key = self._shard_for_key(key)
+        shard, new_key = self._shard_for_key_cache.get(key) or self._shard_for_key(key)
+        if self._metadata_cache is not None:
+            return self._get_metadata_cached(shard, new_key)
+        if self._write_buffers:
+            self._flush_write_buffer(shard)
         return shard[new_key]
 
+    def _get_metadata_cached(self, shard, new_key):
+        cache_key = (id(shard), new_key)
+        value = self._metadata_cache.get(cache_key)
+        if value is not None:
+            return value
+        if self._write_buffers:
+            self._flush_write_buffer(shard)
+        value = shard[new_key]
+        if new_key.rsplit("/", 1)[-1] in _meta_keys:
+            self._metadata_cache[cache_key] = value
+        return value
+
     def __setitem__(self, key, value):
-        shard, new_key = self._shard_for_key(key, value)
-        shard[new_key] = value
+        shard, new_key = self._shard_for_key_cache.get(key) or self._shard_for_key(key)
+        self._cached_len = None
+        if self._metadata_cache:
+            self._metadata_cache.pop((id(shard), new_key), None)
+        # Routing has no side effects, so array metadata writes are detected here
+        if shard is self.base and new_key in self._array_meta_key_mounts:
+            mount_path = self._array_meta_key_mounts[new_key]
+            # Rewriting the same metadata, e.g. on re-open, keeps the shards
+            if self._array_metas.get(mount_path) != value:
+                self._create_array_shards(
+                    mount_path, self.array_shards[mount_path], value
+                )
+                self._array_metas[mount_path] = bytes(value)
+        if self._write_batch_size and id(shard) in self._array_shard_ids:
+            self._buffer_write(shard, new_key, value)
+        else:
+            shard[new_key] = value
+
+    def _keys_per_shard(self, keys):
+        """Group keys by the store that holds them.
+
+        Returns (store, {new_key: key}) pairs."""
+        keys_per_shard = {}
+        for key in keys:
+            shard, new_key = self._shard_for_key_cache.get(key) or self._shard_for_key(
+                key
+            )
+            shard_id = id(shard)
+            if shard_id not in keys_per_shard:
+                keys_per_shard[shard_id] = (shard, {})
+            keys_per_shard[shard_id][1][new_key] = key
+        return keys_per_shard.values()
+
+    def getitems(self, keys, *, contexts=None, **kwargs):
+        """Retrieve data from multiple keys, with one request per shard store.
+
+        Additional keyword arguments, e.g. the ``on_error`` passed by older zarr
+        versions, are forwarded to the shard stores that accept them."""
+        results = {}
+        metadata_cache = self._metadata_cache
+        for shard, shard_keys in self._keys_per_shard(keys):
+            if metadata_cache:
+                for new_key in list(shard_keys):
+                    value = metadata_cache.get((id(shard), new_key))
+                    if value is not None:
+                        results[shard_keys.pop(new_key)] = value
+                if not shard_keys:
+                    continue
+            if self._write_buffers:
+                self._flush_write_buffer(shard)
+            if hasattr(shard, "getitems"):
+                shard_contexts = {}
+                if contexts:
+                    shard_contexts = {
+                        new_key: contexts[key]
+                        for new_key, key in shard_keys.items()
+                        if key in contexts
+                    }
+                shard_kwargs = dict(kwargs, contexts=shard_contexts)
+                accepted = _getitems_parameters(type(shard))
+                if accepted is not None:
+                    shard_kwargs = {
+                        k: v for k, v in shard_kwargs.items() if k in accepted
+                    }
+                values = shard.getitems(list(shard_keys), **shard_kwargs)
+            else:
+                values = {k: shard[k] for k in shard_keys if k in shard}
+            for new_key, value in values.items():
+                results[shard_keys[new_key]] = value
+                if (
+                    metadata_cache is not None
+                    and new_key.rsplit("/", 1)[-1] in _meta_keys
+                ):
+                    metadata_cache[(id(shard), new_key)] = value
+        return results
+
+    def setitems(self, values):
+        """Set multiple keys, with one request per shard store."""
+        # Metadata is written first and on its own, since writing array metadata
+        # creates the array shard stores that the chunks are written to.
+        keys = []
+        for key, value in values.items():
+            if key.rsplit("/", 1)[-1] in _meta_keys:
+                self[key] = value
+            else:
+                keys.append(key)
+
+        self._cached_len = None
+        for shard, shard_keys in self._keys_per_shard(keys):
+            shard_values = {new_key: values[key] for new_key, key in shard_keys.items()}
+            if self._metadata_cache:
+                for new_key in shard_keys:
+                    self._metadata_cache.pop((id(shard), new_key), None)
+            if self._write_batch_size and id(shard) in self._array_shard_ids:
+                for new_key, value in shard_values.items():
+                    self._buffer_write(shard, new_key, value)
+            else:
+                self._set_shard_items(shard, shard_values)
+
+    def delitems(self, keys):
+        """Remove the keys that exist, with one request per shard store."""
+        self._cached_len = None
+        for shard, shard_keys in self._keys_per_shard(keys):
+            if self._write_buffers:
+                self._flush_write_buffer(shard)
+            if self._metadata_cache:
+                for new_key in shard_keys:
+                    self._metadata_cache.pop((id(shard), new_key), None)
+            if hasattr(shard, "delitems"):
+                shard.delitems(list(shard_keys))
+            else:
+                for new_key in shard_keys:
+                    if new_key in shard:
+                        del shard[new_key]
+            if shard is self.base and self._array_metas:
+                for new_key in shard_keys:
+                    if new_key in self._array_meta_key_mounts:
+                        self._array_metas.pop(
+                            self._array_meta_key_mounts[new_key], None
+                        )
 
-    @staticmethod
-    def _shard_iter(shards):
-        for mount, shard in shards.items():
-            for k in iter(shard):
-                yield mount + "/" + k
+    def update(self, *args, **kwargs):
+        self.setitems(dict(*args, **kwargs))
 
     def __iter__(self):
-        return itertools.chain(self.base, self._shard_iter(self.shards))
+        self.flush()
+        yield from self.base
+        for mount, shard in self.shards.items():
+            prefix = mount + "/"
+            for k in shard:
+                yield prefix + k
+        # Chunk keys in the array shards follow the sharded chunk indices
+        separator = self._dimension_separator or "."
+        for mount, array_shards in self.array_shards.items():
+            for chunk_prefix, array_shard in array_shards.items():
+                prefix = f"{mount}/{chunk_prefix}{separator}"
+                for k in array_shard:
+                    # The array metadata is served from the base store
+                    if k not in _meta_keys:
+                        yield prefix + k
+
+    def _store_len(self, store):
+        if id(store) in self._array_shard_ids:
+            return _array_shard_len(store)
+        return len(store)
 
     def __len__(self):
-        return sum(
-            [
-                len(self.base),
-            ]
-            + [len(s) for s in self.shards.values()]
+        if self._cached_len is not None:
+            return self._cached_len
+        self.flush()
+        length = sum(
+            _map_stores(self._store_len, self._all_stores, self._component_max_workers)
         )
+        if self._enable_len_cache:
+            self._cached_len = length
+        return length
+
+    def _find_mount(self, path: str):
+        """Find the mount path trie node for a normalized directory path.
+
+        Returns the node, which is None when the path is not in the trie, the
+        record of the mount containing the path, if any, and the path relative
+        to the mount."""
+        node = self._mount_trie
+        segments = path.split("/") if path else []
+        for i, segment in enumerate(segments):
+            node = node.get(segment)
+            if node is None:
+                return None, None, ""
+            if None in node:
+                return node, node[None], "/".join(segments[i + 1 :])
+        return node, None, ""
+
+    def listdir(self, path: str = ""):
+        path = normalize_storage_path(path)
+        self.flush()
+        node, mount, relative_path = self._find_mount(path)
+        if mount is None:
+            children = zarr.storage.listdir(self.base, path)
+            if node:
+                # Mounts below the path are children of the path in the base store
+                children = sorted(set(children).union(node))
+            return children
+
+        mount_path, shard, is_array_shard = mount[:3]
+        if not is_array_shard:
+            return zarr.storage.listdir(shard, relative_path)
+
+        # Array metadata and unsharded chunks are in the base store
+        children = set(zarr.storage.listdir(self.base, path))
+        prefix = relative_path + "/" if relative_path else ""
+        separator = self._dimension_separator or "."
+        for chunk_prefix, array_shard in shard.items():
+            for k in array_shard:
+                if k in _meta_keys:
+                    continue
+                key = f"{chunk_prefix}{separator}{k}"
+                if len(key) > len(prefix) and key.startswith(prefix):
+                    children.add(key[len(prefix) :].split("/", 1)[0])
+        return sorted(children)
+
+    def getsize(self, path: str = ""):
+        path = normalize_storage_path(path)
+        self.flush()
+        node, mount, relative_path = self._find_mount(path)
+        if mount is None:
+            return zarr.storage.getsize(self.base, path)
+
+        mount_path, shard, is_array_shard = mount[:3]
+        if not is_array_shard:
+            return zarr.storage.getsize(shard, relative_path)
+
+        shard, new_key = self._shard_for_key(path)
+        if new_key in shard:
+            return zarr.storage.getsize(shard, new_key)
+        # Like the stores, only the size of the keys directly in the path
+        size = 0
+        for child in self.listdir(path):
+            shard, new_key = self._shard_for_key(f"{path}/{child}")
+            if new_key in shard:
+                size += zarr.storage.getsize(shard, new_key)
+        return size
@@ -1,21 +1,24 @@
 import tempfile
 import os
+import shutil
+import threading
 
 import pytest
 
 import numpy as np
-import xarray as xr
-from datatree import DataTree
-import datatree
+import zarr
+from numcodecs import Delta
 import json
 
+import shardedstore
 from shardedstore import (
     ShardedStore,
     array_shard_directory_store,
+    to_zip_store,
     to_zip_store_with_prefix,
 )
 
-from zarr.storage import DirectoryStore
+from zarr.storage import DirectoryStore, MemoryStore
 
 
 def test_shardedstore():
@@ -80,6 +83,9 @@ def test_shardedstore():
         assert sharded_store._shard_for_key("people/bob")[0] == shard1
         assert sharded_store._shard_for_key("people/bob")[1] == "bob"
 
+        assert sharded_store._shard_for_key("peoplex/bob")[0] == base_store
+        assert sharded_store._shard_for_key("peoplex/bob")[1] == "peoplex/bob"
+
         assert sharded_store._shard_for_key("simulation")[0] == base_store
         assert sharded_store._shard_for_key("simulation")[1] == "simulation"
 
@@ -101,17 +107,34 @@ def test_shardedstore():
         sharded_store["simulation/fine/shard2"] = shard2_content
         assert sharded_store["simulation/fine/shard2"] == shard2_content
 
+        assert "people/shard1" in sharded_store
+        assert "people/shard2" not in sharded_store
+        assert "simulation/fine/shard2" in sharded_store
+
+        sharded_store.setitems({"base2": base_content, "people/shard2": shard1_content})
+        keys = ["base2", "people/shard2", "people/missing"]
+        assert sharded_store.getitems(keys, contexts={}) == {
+            "base2": base_content,
+            "people/shard2": shard1_content,
+        }
+        sharded_store.delitems(keys)
+        assert "base2" not in sharded_store
+        assert "people/shard2" not in shard1
+
         assert len(sharded_store) == 3
         expected = ["base", "people/shard1", "simulation/fine/shard2"]
-        for i, k in enumerate(sharded_store):
-            assert expected[i] == k
+        assert sharded_store.listdir() == ["base", "people", "simulation"]
+        assert sharded_store.listdir("simulation") == ["fine"]
+        assert sharded_store.listdir("simulation/fine") == ["shard2"]
+        assert sharded_store.getsize("people/shard1") == len(shard1_content)
+        assert sharded_store.getsize("people") == len(shard1_content)
+        assert sorted(sharded_store) == sorted(expected)
 
         del sharded_store["base"]
         del sharded_store["people/shard1"]
         assert len(sharded_store) == 1
         expected = ["simulation/fine/shard2"]
-        for i, k in enumerate(sharded_store):
-            assert expected[i] == k
+        assert sorted(sharded_store) == sorted(expected)
 
         config = sharded_store.get_config()
         config_str = json.dumps(config)
@@ -121,8 +144,332 @@ def test_shardedstore():
         sharded_store.close()
 
 
+def test_shardedstore_len_cache():
+    base_store = MemoryStore()
+    shard1 = MemoryStore()
+    sharded_store = ShardedStore(base_store, {"people": shard1}, enable_len_cache=True)
+
+    sharded_store["base"] = "base_content".encode()
+    sharded_store["people/shard1"] = "shard1_content".encode()
+    assert len(sharded_store) == 2
+
+    # Writes to the component stores bypass the cache
+    shard1["shard2"] = "shard2_content".encode()
+    assert len(sharded_store) == 2
+
+    del sharded_store["base"]
+    assert len(sharded_store) == 2
+
+
+def test_shardedstore_cache_metadata():
+    base_store = MemoryStore()
+    shard1 = MemoryStore()
+    sharded_store = ShardedStore(base_store, {"people": shard1}, cache_metadata=True)
+
+    group_meta = b'{"zarr_format": 2}'
+    sharded_store["people/.zgroup"] = group_meta
+    assert sharded_store["people/.zgroup"] == group_meta
+
+    # Writes to the component stores bypass the cache
+    shard1[".zgroup"] = b"{}"
+    assert sharded_store["people/.zgroup"] == group_meta
+    assert sharded_store.getitems(["people/.zgroup"]) == {"people/.zgroup": group_meta}
+
+    sharded_store.setitems({"people/.zgroup": b"{}"})
+    assert sharded_store["people/.zgroup"] == b"{}"
+    del sharded_store["people/.zgroup"]
+    assert "people/.zgroup" not in sharded_store
+
+
+def test_shardedstore_close_errors():
+    closed = []
+
+    class ClosingStore(MemoryStore):
+        def __init__(self, name, error=None):
+            super().__init__()
+            self.name = name
+            self.error = error
+
+        def close(self):
+            closed.append(self.name)
+            if self.error:
+                raise self.error
+
+    sharded_store = ShardedStore(
+        ClosingStore("base"),
+        {
+            "people": ClosingStore("people", RuntimeError("people")),
+            "species": ClosingStore("species"),
+        },
+    )
+    with pytest.raises(RuntimeError, match="people"):
+        sharded_store.close()
+    assert sorted(closed) == ["base", "people", "species"]
+
+
+def test_shardedstore_write_batch_size():
+    base_store = MemoryStore(dimension_separator="/")
+    array_shards = {}
+
+    def array_shard_memory_store(chunk_dims):
+        array_shards[chunk_dims] = MemoryStore(dimension_separator="/")
+        return array_shards[chunk_dims]
+
+    sharded_store = ShardedStore(
+        base_store, None, {"data": (1, array_shard_memory_store)}, write_batch_size=4
+    )
+    data = np.arange(24).reshape(2, 3, 4)
+    z = zarr.create(
+        data.shape,
+        chunks=(1, 3, 2),
+        dtype=data.dtype,
+        filters=[Delta(dtype=data.dtype)],
+        store=sharded_store,
+        path="data",
+    )
+    for array_shard in array_shards.values():
+        array_meta = json.loads(array_shard[".zarray"])
+        # The sharded dimension is folded into the leading remaining dimension
+        assert array_meta["shape"] == [6, 4]
+        assert array_meta["chunks"] == [3, 2]
+    z[0] = data[0]
+    # Two chunks per sharded index, below the batch size
+    assert "0/0" not in array_shards["0"]
+    z[1] = data[1]
+    z[0, 0, :2] = 100
+    data[0, 0, :2] = 100
+    assert (z[:] == data).all()
+
+    sharded_store.close()
+    assert "0/0" in array_shards["0"]
+    assert "0/1" in array_shards["1"]
+
+
+def _array_sharded_store(data, array_shards):
+    """A ShardedStore with data written to an array sharded over 1 dimension."""
+
+    def array_shard_memory_store(chunk_dims):
+        array_shards[chunk_dims] = MemoryStore()
+        return array_shards[chunk_dims]
+
+    sharded_store = ShardedStore(
+        MemoryStore(), None, {"data": (1, array_shard_memory_store)}
+    )
+    z = zarr.create(
+        data.shape,
+        chunks=(1, 2),
+        dtype=data.dtype,
+        compressor=None,
+        store=sharded_store,
+        path="data",
+    )
+    z[:] = data
+    return sharded_store
+
+
+def test_shardedstore_array_shards_without_compressor():
+    array_shards = {}
+    data = np.arange(8).reshape(2, 4)
+    sharded_store = _array_sharded_store(data, array_shards)
+    assert sorted(array_shards) == ["0", "1"]
+    assert (zarr.open_array(sharded_store, path="data")[:] == data).all()
+
+
+def test_shardedstore_array_meta_rewrite():
+    array_shards = {}
+    data = np.arange(8).reshape(2, 4)
+    sharded_store = _array_sharded_store(data, array_shards)
+    # Rewriting the same array metadata does not recreate the shards
+    created = dict(array_shards)
+    sharded_store["data/.zarray"] = sharded_store["data/.zarray"]
+    assert array_shards == created
+    assert (zarr.open_array(sharded_store, path="data")[:] == data).all()
+
+
+def test_shardedstore_array_shards_iter():
+    data = np.arange(8).reshape(2, 4)
+    sharded_store = _array_sharded_store(data, {})
+    assert sorted(sharded_store) == [
+        ".zgroup",
+        "data/.zarray",
+        "data/0.0",
+        "data/0.1",
+        "data/1.0",
+        "data/1.1",
+    ]
+
+
+def test_shardedstore_array_shards_len():
+    data = np.arange(8).reshape(2, 4)
+    sharded_store = _array_sharded_store(data, {})
+    assert len(sharded_store) == 6
+
+
+def test_shardedstore_array_shards_listdir_getsize():
+    data = np.arange(8).reshape(2, 4)
+    sharded_store = _array_sharded_store(data, {})
+    assert sharded_store.listdir("data") == [".zarray", "0.0", "0.1", "1.0", "1.1"]
+    assert sharded_store.getsize("data/0.1") == 2 * data.itemsize
+    assert (
+        sharded_store.getsize("data")
+        == sharded_store.getsize("data/.zarray") + 4 * 2 * data.itemsize
+    )
+
+
+def test_shardedstore_map_shards():
+    # Multi-digit chunk indices over multiple sharded dimensions
+    sharded_store = ShardedStore(
+        MemoryStore(dimension_separator="/"),
+        None,
+        {"data": (2, lambda chunk_dims: MemoryStore(dimension_separator="/"))},
+        dimension_separator="/",
+    )
+    data = np.arange(11 * 11 * 4).reshape(11, 11, 4)
+    z = zarr.create(
+        data.shape, chunks=(1, 1, 2), dtype=data.dtype, store=sharded_store, path="data"
+    )
+    z[:] = data
+    array_shards = sharded_store.array_shards["data"]
+    assert "10/10" in array_shards
+
+    mapped_store = sharded_store.map_shards(lambda store, path, chunk_path: store)
+    assert mapped_store.array_shard_dims == {"data": 2}
+    assert mapped_store._shard_for_key("data/10/10/1") == (array_shards["10/10"], "1")
+    assert (zarr.open_array(mapped_store, path="data")[:] == data).all()
+
+
+@pytest.mark.parametrize("dimension_separator", ["/", "."])
+def test_shardedstore_array_path_keys_in_base(dimension_separator):
+    # Keys under an array path that are not chunks of the array shards
+    base = MemoryStore(dimension_separator=dimension_separator)
+    sharded_store = ShardedStore(
+        base,
+        None,
+        {
+            "data": (
+                2,
+                lambda chunk_dims: MemoryStore(dimension_separator=dimension_separator),
+            )
+        },
+        dimension_separator=dimension_separator,
+    )
+    zarr.create((2, 2, 4), chunks=(1, 1, 2), store=sharded_store, path="data")
+    assert "data/foo" not in sharded_store
+    with pytest.raises(KeyError):
+        sharded_store["data/foo"]
+    sharded_store["data/foo"] = b"foo"
+    assert base["data/foo"] == b"foo"
+    assert sharded_store["data/foo"] == b"foo"
+
+
+def test_shardedstore_in_memory_without_threads(monkeypatch):
+    def no_executor(*args, **kwargs):
+        raise AssertionError("In-memory stores are accessed from the calling thread")
+
+    monkeypatch.setattr(
+        shardedstore.concurrent.futures, "ThreadPoolExecutor", no_executor
+    )
+    data = np.arange(8).reshape(2, 4)
+    sharded_store = _array_sharded_store(data, {})
+    assert len(sharded_store) == 6
+    sharded_store.close()
+
+
+def test_shardedstore_map_shards_serial():
+    data = np.arange(8).reshape(2, 4)
+    sharded_store = _array_sharded_store(data, {})
+    threads = set()
+
+    def identity(store, path, chunk_path):
+        threads.add(threading.get_ident())
+        return store
+
+    mapped_store = sharded_store.map_shards(identity, max_workers=1)
+    assert threads == {threading.get_ident()}
+    assert (zarr.open_array(mapped_store, path="data")[:] == data).all()
+
+
+def test_to_zip_store_with_prefix_removed_output():
+    data = np.arange(8).reshape(2, 4)
+    sharded_store = _array_sharded_store(data, {})
+    with tempfile.TemporaryDirectory(prefix="test_to_zip_store") as folder:
+        prefix = os.path.join(folder, "zip_stores")
+        to_zip_stores = to_zip_store_with_prefix(prefix)
+        sharded_store.map_shards(to_zip_stores).close()
+        # The output directories are created again for each run
+        shutil.rmtree(prefix)
+        os.remove(prefix + ".zarr.zip")
+        zip_sharded_store = sharded_store.map_shards(to_zip_stores)
+        assert (zarr.open_array(zip_sharded_store, path="data")[:] == data).all()
+        zip_sharded_store.close()
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_to_zip_store_batches(max_workers):
+    # More keys than are read in a batch
+    shard_store = MemoryStore()
+    for i in range(2 * shardedstore._copy_batch_size + 1):
+        shard_store[f"data/{i}"] = str(i).encode()
+    with tempfile.TemporaryDirectory(prefix="test_to_zip_store") as folder:
+        zip_store = to_zip_store(
+            os.path.join(folder, "zip_stores"),
+            shard_store,
+            "shard",
+            None,
+            max_workers=max_workers,
+        )
+        assert dict(zip_store) == dict(shard_store)
+        zip_store.close()
+
+
+def test_shardedstore_from_config_array_shard_dims():
+    with tempfile.TemporaryDirectory(prefix="test_from_config") as folder:
+        sharded_store = ShardedStore(
+            DirectoryStore(os.path.join(folder, "base.zarr")),
+            None,
+            {
+                "data": (
+                    2,
+                    array_shard_directory_store(os.path.join(folder, "array_shards")),
+                )
+            },
+        )
+        zarr.create((11, 11, 4), chunks=(1, 1, 2), store=sharded_store, path="data")
+        assert "10/10" in sharded_store.array_shards["data"]
+
+        config = json.loads(json.dumps(sharded_store.get_config()))
+        assert ShardedStore.from_config(config).array_shard_dims == {"data": 2}
+
+
+@pytest.fixture(scope="module")
+def sample_datatree():
+    import xarray as xr
+    from datatree import DataTree
+
+    # xarray-datatree Quick Overview
+    data = xr.DataArray(
+        np.random.default_rng(0).standard_normal((3, 3, 5)),
+        dims=("x", "y", "z"),
+        coords={"x": [4, 10, 20]},
+    )
+    data = data.chunk([1, 2, 2])
+    ds = xr.Dataset(dict(foo=data, bar=("x", [0, 1, 2]), baz=np.pi))
+    ds2 = ds.interp(coords={"x": [10, 12, 14, 16, 18, 20]})
+    ds2 = ds2.chunk({"x": 1, "y": 1, "z": 2})
+    ds3 = xr.Dataset(
+        dict(people=["alice", "bob"], heights=("people", [1.57, 1.82])),
+        coords={"species": "human"},
+    )
+    return DataTree.from_dict(
+        {"simulation/coarse": ds, "simulation/fine": ds2, "/": ds3}
+    )
+
+
 @pytest.mark.parametrize("dimension_separator", ["/", ".", None])
-def test_datatree_shardedstore(dimension_separator):
+def test_datatree_shardedstore(dimension_separator, sample_datatree):
+    import datatree
+
+    dt = sample_datatree
     with tempfile.TemporaryDirectory(prefix="test_datatree_shardedstore") as folder:
         base_store = DirectoryStore(
             os.path.join(folder, "base.zarr"), dimension_separator=dimension_separator
@@ -142,22 +489,6 @@ def test_datatree_shardedstore(dimension_separator):
             dimension_separator=dimension_separator,
         )
 
-        # xarray-datatree Quick Overview
-        data = xr.DataArray(
-            np.random.randn(3, 3, 5), dims=("x", "y", "z"), coords={"x": [4, 10, 20]}
-        )
-        data = data.chunk([1, 2, 2])
-        ds = xr.Dataset(dict(foo=data, bar=("x", [0, 1, 2]), baz=np.pi))
-        ds2 = ds.interp(coords={"x": [10, 12, 14, 16, 18, 20]})
-        ds2 = ds2.chunk({"x": 1, "y": 1, "z": 2})
-        ds3 = xr.Dataset(
-            dict(people=["alice", "bob"], heights=("people", [1.57, 1.82])),
-            coords={"species": "human"},
-        )
-        dt = DataTree.from_dict(
-            {"simulation/coarse": ds, "simulation/fine": ds2, "/": ds3}
-        )
-
         single_store = DirectoryStore(
             os.path.join(folder, "single.zarr"), dimension_separator=dimension_separator
         )
@@ -173,6 +504,11 @@ def test_datatree_shardedstore(dimension_separator):
         )
         dt.to_zarr(sharded_store)
 
+        assert sharded_store.is_readable()
+        assert sharded_store.is_writeable()
+        assert sharded_store.is_listable()
+        assert sharded_store.is_erasable()
+
         config = sharded_store.get_config()
         config_str = json.dumps(config)
         config = json.loads(config_str)